@@ -40,16 +40,26 @@ import os
 import sys
 import argparse
 import netrc
-from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from urllib.parse import quote_plus
 from enum import Enum
-import json
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from lobster.items import Tracing_Tag, Requirement
 from lobster.location import Codebeamer_Reference
 from lobster.errors import Message_Handler, LOBSTER_Error
 from lobster.io import lobster_read, lobster_write
 
+# orjson is an optional, faster drop-in for decoding the (potentially
+# large) REST responses
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
+
 
 class References(Enum):
     REFS = "refs"
@@ -57,13 +67,16 @@ class References(Enum):
 
 SUPPORTED_REFERENCES = [References.REFS.value]
 
+ITEMS_PER_QUERY = 200
+
 
 def add_refs_refrences(req, flat_values_list):
     # refs
+    add_tracing_target = req.add_tracing_target
     for value in flat_values_list:
-        if value.get("id"):
-            ref_id = value.get("id")
-            req.add_tracing_target(Tracing_Tag("req", str(ref_id)))
+        ref_id = value.get("id")
+        if ref_id:
+            add_tracing_target(Tracing_Tag("req", str(ref_id)))
 
 
 map_reference_name_to_function = {
@@ -76,11 +89,16 @@ def query_cb_single(cb_config, url):
     assert isinstance(url, str)
 
     try:
-        result = requests.get(url,
-                              auth=(cb_config["user"],
-                                    cb_config["pass"]),
-                              timeout=cb_config["timeout"],
-                              verify=cb_config["verify_ssl"])
+        result = cb_config["session"].get(url,
+                                          auth=(cb_config["user"],
+                                                cb_config["pass"]),
+                                          timeout=cb_config["timeout"],
+                                          verify=cb_config["verify_ssl"],
+                                          stream=True)
+        # Since we stream, this is where the body is actually
+        # downloaded. Read it in large chunks, rather than the small
+        # default chunks used by result.content.
+        body = b"".join(result.iter_content(chunk_size=65536))
     except requests.exceptions.ReadTimeout:
         print("Timeout when fetching %s" % url)
         print("You can either:")
@@ -95,10 +113,10 @@ def query_cb_single(cb_config, url):
     if result.status_code != 200:
         print("Could not fetch %s" % url)
         print("Status = %u" % result.status_code)
-        print(result.text)
+        print(body.decode("utf-8", errors="replace"))
         sys.exit(1)
 
-    return result.json()
+    return _json.loads(body)
 
 
 def get_single_item(cb_config, item_id):
@@ -110,26 +128,57 @@ def get_single_item(cb_config, item_id):
     return data
 
 
+def get_num_pages(data):
+    return (data["total"] + data["pageSize"] - 1) // data["pageSize"]
+
+
+def get_all_pages(cb_config, fetch_page, queries):
+    # Fetch the first page of each query to learn how many pages there
+    # are, the remaining pages are independent of each other and so
+    # can be fetched in parallel.
+    assert isinstance(cb_config, dict)
+    assert isinstance(queries, list)
+
+    with ThreadPoolExecutor(
+            max_workers=cb_config.get("max_concurrency", 8)) as executor:
+        first_pages = list(executor.map(lambda query: fetch_page(query, 1),
+                                        queries))
+
+        remaining = [(query_idx, page_id)
+                     for query_idx, first_page in enumerate(first_pages)
+                     for page_id in range(2, get_num_pages(first_page) + 1)]
+        pages = dict(zip(remaining,
+                         executor.map(lambda key: fetch_page(queries[key[0]],
+                                                             key[1]),
+                                      remaining)))
+
+    for query_idx, first_page in enumerate(first_pages):
+        pages[(query_idx, 1)] = first_page
+
+    return [pages[key] for key in sorted(pages)]
+
+
 def get_many_items(cb_config, item_ids):
     assert isinstance(item_ids, set)
 
-    rv = []
+    # Asking for all items in a single query can create URLs that are
+    # too long for the server, so we split the query into chunks.
+    ids = sorted(item_ids)
+    chunks = [ids[i:i + ITEMS_PER_QUERY]
+              for i in range(0, len(ids), ITEMS_PER_QUERY)]
 
-    page_id = 1
-    query_string = quote(f"item.id IN "
-                         f"({','.join(str(item_id) for item_id in item_ids)})")
-
-    while True:
+    def fetch_page(chunk, page_id):
+        query_string = quote_plus(
+            "item.id IN (%s)" % ",".join(str(item_id) for item_id in chunk),
+            safe=",")
         base_url = "%s/items/query?page=%u&pageSize=%u&queryString=%s"\
                    % (cb_config["base"], page_id,
                       cb_config["page_size"], query_string)
-        data = query_cb_single(cb_config, base_url)
-        rv += data["items"]
-        if len(rv) == data["total"]:
-            break
-        page_id += 1
+        return query_cb_single(cb_config, base_url)
 
-    return rv
+    pages = get_all_pages(cb_config, fetch_page, chunks)
+
+    return list(chain.from_iterable(data["items"] for data in pages))
 
 
 def get_query(mh, cb_config, query_id):
@@ -137,11 +186,8 @@ def get_query(mh, cb_config, query_id):
     assert isinstance(cb_config, dict)
     assert isinstance(query_id, int)
     rv = []
-    page_id = 1
-    total_items = None
 
-    while total_items is None or len(rv) < total_items:
-        print("Fetching page %u of query..." % page_id)
+    def fetch_page(query_id, page_id):
         url = "%s/reports/%u/items?page=%u&pageSize=%u" % \
             (cb_config["base"],
              query_id,
@@ -158,15 +204,19 @@ def get_query(mh, cb_config, query_id):
             sys.exit(1)
 
         assert page_id == data["page"]
-        if page_id == 1:
-            total_items = data["total"]
-        else:
-            assert total_items == data["total"]
+        return data
 
-        rv += [to_lobster(cb_config, cb_item["item"])
-               for cb_item in data["items"]]
+    # Pages are fetched in parallel, so we only report progress here
+    # on the main thread.
+    print("Fetching query %u..." % query_id)
+    pages = get_all_pages(cb_config, fetch_page, [query_id])
+    print("Fetched %u pages of query %u" % (len(pages), query_id))
+    total_items = pages[0]["total"]
 
-        page_id += 1
+    for data in pages:
+        assert total_items == data["total"]
+        rv.extend(to_lobster(cb_config, cb_item["item"])
+                  for cb_item in data["items"])
 
     assert total_items == len(rv)
 
@@ -177,6 +227,18 @@ def to_lobster(cb_config, cb_item):
     assert isinstance(cb_config, dict)
     assert isinstance(cb_item, dict) and "id" in cb_item
 
+    item_id    = cb_item["id"]
+    version    = cb_item["version"]
+    tracker_id = cb_item["tracker"]["id"]
+
+    # The same item (at the same version) always converts to the same
+    # lobster item, so there is no need to build it again.
+    cache = cb_config.get("cache")
+    if cache is not None:
+        cache_key = (item_id, version)
+        if cache_key in cache:
+            return cache[cache_key]
+
     # This looks like it's business logic, maybe we should make this
     # configurable?
 
@@ -198,16 +260,16 @@ def to_lobster(cb_config, cb_item):
     if "name" in cb_item:
         item_name = cb_item["name"]
     else:
-        item_name = "Unnamed item %u" % cb_item["id"]
+        item_name = "Unnamed item %u" % item_id
 
     req = Requirement(
         tag       = Tracing_Tag(namespace = "req",
-                                tag       = str(cb_item["id"]),
-                                version   = cb_item["version"]),
+                                tag       = str(item_id),
+                                version   = version),
         location  = Codebeamer_Reference(cb_root = cb_config["root"],
-                                         tracker = cb_item["tracker"]["id"],
-                                         item    = cb_item["id"],
-                                         version = cb_item["version"],
+                                         tracker = tracker_id,
+                                         item    = item_id,
+                                         version = version,
                                          name    = item_name),
         framework = "codebeamer",
         kind      = kind,
@@ -216,6 +278,9 @@ def to_lobster(cb_config, cb_item):
         status    = status)
 
     if cb_config.get('references'):
+        custom_fields = {custom_field["name"]: custom_field.get("values") or []
+                         for custom_field in cb_item.get("customFields", ())}
+
         for reference_name, displayed_chosen_names in (
                 cb_config['references'].items()):
             if reference_name not in map_reference_name_to_function:
@@ -227,18 +292,16 @@ def to_lobster(cb_config, cb_item):
                         isinstance(cb_item.get(displayed_name), list)) \
                         else [cb_item.get(displayed_name)]
                 else:
-                    flat_values_list = (
-                        list(value for custom_field
-                             in cb_item["customFields"]
-                             if custom_field["name"] == displayed_name and
-                             custom_field.get("values")
-                             for value in custom_field["values"]))
+                    flat_values_list = custom_fields.get(displayed_name, [])
                 if not flat_values_list:
                     continue
 
                 (map_reference_name_to_function[reference_name]
                  (req, flat_values_list))
 
+    if cache is not None:
+        cache[cache_key] = req
+
     return req
 
 
@@ -258,8 +321,7 @@ def import_tagged(mh, cb_config, items_to_import):
 
 def ensure_array_of_strings(instance):
     if (isinstance(instance, list) and
-            all(isinstance(item, str)
-                for item in instance)):
+            set(map(type, instance)) <= {str}):
         return instance
     else:
         return [str(instance)]
@@ -269,8 +331,8 @@ def parse_cb_config(file_name):
     assert isinstance(file_name, str)
     assert os.path.isfile(file_name)
 
-    with open(file_name, "r", encoding='utf-8') as file:
-        data = json.loads(file.read())
+    with open(file_name, "rb") as file:
+        data = _json.loads(file.read())
 
     provided_config_keys = set(data.keys())
     supported_references = set(SUPPORTED_REFERENCES)
@@ -318,6 +380,17 @@ def main():
                     type=int,
                     default=30,
                     help="Timeout in s (by default 30) for each REST call.")
+    ap.add_argument("--max-concurrency",
+                    type=int,
+                    default=8,
+                    help=("Fetch at most this many pages in parallel"
+                          " (by default 8)."))
+
+    ap.add_argument("--no-cache",
+                    action="store_true",
+                    default=False,
+                    help=("do not re-use the conversion of codebeamer items"
+                          " that are returned more than once"))
 
     ap.add_argument("--cb-root", default=os.environ.get("CB_ROOT", None))
     ap.add_argument("--cb-user", default=os.environ.get("CB_USERNAME", None))
@@ -328,15 +401,22 @@ def main():
     mh = Message_Handler()
 
     cb_config = {
-        "root"       : options.cb_root,
-        "base"       : "%s/cb/api/v3" % options.cb_root,
-        "user"       : options.cb_user,
-        "pass"       : options.cb_pass,
-        "verify_ssl" : not options.ignore_ssl_errors,
-        "page_size"  : options.query_size,
-        "timeout"    : options.timeout,
+        "root"            : options.cb_root,
+        "base"            : "%s/cb/api/v3" % options.cb_root,
+        "user"            : options.cb_user,
+        "pass"            : options.cb_pass,
+        "verify_ssl"      : not options.ignore_ssl_errors,
+        "page_size"       : options.query_size,
+        "timeout"         : options.timeout,
+        "max_concurrency" : options.max_concurrency,
     }
 
+    if not options.no_cache:
+        cb_config["cache"] = {}
+
+    if cb_config["max_concurrency"] < 1:
+        ap.error("max-concurrency must be positive")
+
     if options.config:
         if os.path.isfile(options.config):
             cb_config["references"] = parse_cb_config(options.config)
@@ -400,19 +480,40 @@ def main():
         if query_id < 1:
             ap.error("query-id must be a positive")
 
-    try:
-        if options.import_tagged:
-            items = import_tagged(mh, cb_config, items_to_import)
-        elif options.import_query:
-            items = get_query(mh, cb_config, query_id)
-    except LOBSTER_Error:
-        return 1
+    if options.import_tagged and not items_to_import:
+        # Nothing references codebeamer, so there is no need to talk
+        # to it at all.
+        items = []
+
+    else:
+        # Share one session for all REST calls, so that connections
+        # (and their TLS handshake) are re-used between pages.
+        session = requests.Session()
+        # Read errors are not retried, so that a timeout is still
+        # reported as such (and not only after waiting several times).
+        adapter = HTTPAdapter(pool_connections = 50,
+                              pool_maxsize     = 50,
+                              max_retries      = Retry(total = 3,
+                                                       read  = False))
+        session.mount("https://", adapter)
+        cb_config["session"] = session
+
+        with session:
+            try:
+                if options.import_tagged:
+                    items = import_tagged(mh, cb_config, items_to_import)
+                elif options.import_query:
+                    items = get_query(mh, cb_config, query_id)
+            except LOBSTER_Error:
+                return 1
 
     if options.out is None:
         lobster_write(sys.stdout, Requirement, "lobster_codebeamer", items)
         print()
     else:
-        with open(options.out, "w", encoding="UTF-8") as fd:
+        # json.dump issues many small writes, so use a large buffer
+        with open(options.out, "w", encoding="UTF-8",
+                  buffering=1 << 20) as fd:
             lobster_write(fd, Requirement, "lobster_codebeamer", items)
         print("Written %u requirements to %s" % (len(items),
                                                  options.out))
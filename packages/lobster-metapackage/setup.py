@@ -19,21 +19,21 @@ with open("requirements", "r") as fd:
                             for line in fd.read().splitlines()
                             if line.strip()]
 
+
 # For the readme to look right on PyPI we need to translate any
 # relative links to absolute links to github.
-fixes = []
-for match in re.finditer(r"\[(.*)\]\((.*)\)", long_description):
-    if not match.group(2).startswith("http"):
-        fixes.append((match.span(0)[0], match.span(0)[1],
-                      "[%s](%s/%s/blob/main/%s)" % (match.group(1),
-                                                    gh_root,
-                                                    gh_project,
-                                                    match.group(2))))
+def fix_link(match):
+    if match.group(2).startswith("http"):
+        return match.group(0)
+    return "[%s](%s/%s/blob/main/%s)" % (match.group(1),
+                                         gh_root,
+                                         gh_project,
+                                         match.group(2))
+
 
-for begin, end, text in reversed(fixes):
-    long_description = (long_description[:begin] +
-                        text +
-                        long_description[end:])
+long_description = re.sub(r"\[([^\]]*)\]\(([^)]*)\)",
+                          fix_link,
+                          long_description)
 
 project_urls = {
     "Bug Tracker"   : "%s/%s/issues" % (gh_root, gh_project),
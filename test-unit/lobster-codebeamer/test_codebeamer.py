@@ -1,9 +1,13 @@
+import io
 import unittest
+from contextlib import redirect_stdout
+from urllib.parse import unquote_plus
 from unittest.mock import Mock, patch
 
 from lobster.tools.codebeamer.codebeamer import get_single_item, get_many_items, to_lobster, \
-    import_tagged
+    import_tagged, query_cb_single, ensure_array_of_strings, get_query
 from lobster.errors import Message_Handler
+import requests
 
 list_of_compared_attributes = ['name', 'kind', 'status', 'just_down', 'just_up', 'just_global']
 
@@ -15,6 +19,66 @@ class QueryCodebeamerTest(unittest.TestCase):
             for attr in list_of_compared_attributes:
                 self.assertEqual(getattr(obj1, attr), getattr(obj2, attr), f"{obj1} is not like {obj2} in {attr}")
 
+    def test_query_cb_single_uses_session(self):
+        _url = 'https://test.com/base/items/1'
+        _response = Mock(status_code=200)
+        _response.iter_content.return_value = [b'{"id"', b': 1}']
+        _session = Mock()
+        _session.get.return_value = _response
+        _cb_config = {'user': 'user', 'pass': 'pass', 'timeout': 30,
+                      'verify_ssl': True, 'session': _session}
+
+        query_result = query_cb_single(_cb_config, _url)
+        self.assertEqual(query_result, {'id': 1})
+        _session.get.assert_called_once_with(_url,
+                                             auth=('user', 'pass'),
+                                             timeout=30,
+                                             verify=True,
+                                             stream=True)
+
+    def test_query_cb_single_timeout(self):
+        _session = Mock()
+        _session.get.side_effect = requests.exceptions.ReadTimeout()
+        _cb_config = {'user': 'user', 'pass': 'pass', 'timeout': 30,
+                      'verify_ssl': True, 'session': _session}
+
+        output = io.StringIO()
+        with redirect_stdout(output), self.assertRaises(SystemExit):
+            query_cb_single(_cb_config, 'https://test.com/base/items/1')
+        self.assertIn('Timeout when fetching https://test.com/base/items/1',
+                      output.getvalue())
+        self.assertIn('increase the timeout with --timeout', output.getvalue())
+
+    def test_query_cb_single_body_error(self):
+        _response = Mock(status_code=200)
+        _response.iter_content.side_effect = \
+            requests.exceptions.ConnectionError('connection dropped')
+        _session = Mock()
+        _session.get.return_value = _response
+        _cb_config = {'user': 'user', 'pass': 'pass', 'timeout': 30,
+                      'verify_ssl': True, 'session': _session}
+
+        output = io.StringIO()
+        with redirect_stdout(output), self.assertRaises(SystemExit):
+            query_cb_single(_cb_config, 'https://test.com/base/items/1')
+        self.assertIn('Could not fetch https://test.com/base/items/1',
+                      output.getvalue())
+        self.assertIn('connection dropped', output.getvalue())
+
+    def test_query_cb_single_bad_status(self):
+        _response = Mock(status_code=404)
+        _response.iter_content.return_value = [b'not ', b'found']
+        _session = Mock()
+        _session.get.return_value = _response
+        _cb_config = {'user': 'user', 'pass': 'pass', 'timeout': 30,
+                      'verify_ssl': True, 'session': _session}
+
+        output = io.StringIO()
+        with redirect_stdout(output), self.assertRaises(SystemExit):
+            query_cb_single(_cb_config, 'https://test.com/base/items/1')
+        self.assertIn('Status = 404', output.getvalue())
+        self.assertIn('not found', output.getvalue())
+
     @patch('lobster.tools.codebeamer.codebeamer.query_cb_single')
     def test_get_single_item(self, mock_get):
         _item_id = 11693324
@@ -53,6 +117,116 @@ class QueryCodebeamerTest(unittest.TestCase):
         query_result = get_many_items(_cb_config, _item_ids)
         self.assertEqual(query_result, _response_items)
 
+    @patch('lobster.tools.codebeamer.codebeamer.query_cb_single')
+    def test_get_many_items_multiple_pages(self, mock_get):
+        _item_ids = {1, 2, 3, 4, 5}
+        _cb_config = {'base': 'https://test.com', 'page_size': 2}
+        _pages = {
+            page_id: {
+                'page': page_id,
+                'pageSize': 2,
+                'total': 5,
+                'items': [{'id': item_id}
+                          for item_id in range(page_id * 2 - 1,
+                                               min(page_id * 2, 5) + 1)]
+            }
+            for page_id in (1, 2, 3)
+        }
+
+        def _query(cb_config, url):
+            page_id = int(url.split('page=')[1].split('&')[0])
+            return _pages[page_id]
+
+        mock_get.side_effect = _query
+
+        query_result = get_many_items(_cb_config, _item_ids)
+        self.assertEqual(query_result, [{'id': item_id} for item_id in range(1, 6)])
+        self.assertEqual(mock_get.call_count, 3)
+
+    @patch('lobster.tools.codebeamer.codebeamer.query_cb_single')
+    def test_get_many_items_multiple_queries(self, mock_get):
+        _item_ids = set(range(1, 451))
+        _cb_config = {'base': 'https://test.com', 'page_size': 500}
+
+        def _query(cb_config, url):
+            query_string = unquote_plus(url.split('queryString=')[1])
+            ids = query_string[len('item.id IN ('):-1].split(',')
+            return {
+                'page': 1,
+                'pageSize': 500,
+                'total': len(ids),
+                'items': [{'id': int(item_id)} for item_id in ids]
+            }
+
+        mock_get.side_effect = _query
+
+        query_result = get_many_items(_cb_config, _item_ids)
+        self.assertEqual(query_result, [{'id': item_id} for item_id in range(1, 451)])
+        self.assertEqual(mock_get.call_count, 3)
+
+    @staticmethod
+    def _query_pages(total, page_size, num_pages):
+        return {
+            page_id: {
+                'page': page_id,
+                'pageSize': page_size,
+                'total': total,
+                'items': [{'item': {'id': item_id,
+                                    'name': 'Test name %u' % item_id,
+                                    'version': 1,
+                                    'tracker': {'id': 123}}}
+                          for item_id in range((page_id - 1) * page_size + 1,
+                                               min(page_id * page_size,
+                                                   total) + 1)]
+            }
+            for page_id in range(1, num_pages + 1)
+        }
+
+    @staticmethod
+    def _query_side_effect(pages):
+        def _query(cb_config, url):
+            page_id = int(url.split('page=')[1].split('&')[0])
+            return pages[page_id]
+        return _query
+
+    @patch('lobster.tools.codebeamer.codebeamer.query_cb_single')
+    def test_get_query_multiple_pages(self, mock_get):
+        _cb_config = {'root': 'https://test.com/', 'base': 'https://test.com/base',
+                      'page_size': 2}
+        mock_get.side_effect = self._query_side_effect(self._query_pages(5, 2, 3))
+
+        output = io.StringIO()
+        with redirect_stdout(output):
+            query_result = get_query(Message_Handler(), _cb_config, 42)
+        self.assertEqual([item.name for item in query_result],
+                         ['Test name %u' % item_id for item_id in range(1, 6)])
+        self.assertEqual(mock_get.call_count, 3)
+        self.assertEqual(output.getvalue(),
+                         'Fetching query 42...\nFetched 3 pages of query 42\n')
+
+    @patch('lobster.tools.codebeamer.codebeamer.query_cb_single')
+    def test_get_query_inconsistent_total(self, mock_get):
+        _cb_config = {'root': 'https://test.com/', 'base': 'https://test.com/base',
+                      'page_size': 2}
+        _pages = self._query_pages(5, 2, 3)
+        _pages[2]['total'] = 6
+        mock_get.side_effect = self._query_side_effect(_pages)
+
+        with redirect_stdout(io.StringIO()), self.assertRaises(AssertionError):
+            get_query(Message_Handler(), _cb_config, 42)
+
+    @patch('lobster.tools.codebeamer.codebeamer.query_cb_single')
+    def test_get_query_no_items(self, mock_get):
+        _cb_config = {'root': 'https://test.com/', 'base': 'https://test.com/base',
+                      'page_size': 2}
+        mock_get.side_effect = self._query_side_effect(self._query_pages(0, 2, 1))
+
+        output = io.StringIO()
+        with redirect_stdout(output), self.assertRaises(SystemExit):
+            get_query(Message_Handler(), _cb_config, 42)
+        self.assertIn("This query doesn't generate items", output.getvalue())
+        self.assertEqual(mock_get.call_count, 1)
+
     @patch('lobster.tools.codebeamer.codebeamer.query_cb_single')
     def test_import_tagged(self, mock_get):
         _mh = Message_Handler()
@@ -90,6 +264,48 @@ class QueryCodebeamerTest(unittest.TestCase):
 
         self._assertListEqualByAttributes(import_tagged_result, _expected_result)
 
+    def test_to_lobster_cache(self):
+        _cb_item = {
+            'id': 24406947,
+            'name': 'Test name 1',
+            'version': 7,
+            'tracker': {'id': 123}
+        }
+        _cb_config = {'root': 'https://test.com/', 'cache': {}}
+
+        first_result = to_lobster(_cb_config, _cb_item)
+        self.assertIs(to_lobster(_cb_config, dict(_cb_item)), first_result)
+        self.assertIsNot(to_lobster(_cb_config, dict(_cb_item, version=8)),
+                         first_result)
+
+        del _cb_config['cache']
+        self.assertIsNot(to_lobster(_cb_config, _cb_item), first_result)
+
+    def test_to_lobster_custom_field_references(self):
+        _cb_item = {
+            'id': 24406947,
+            'name': 'Test name 1',
+            'version': 7,
+            'tracker': {'id': 123},
+            'customFields': [
+                {'name': 'other', 'values': [{'id': 1}]},
+                {'name': 'upstream', 'values': [{'id': 2}, {'id': 3}]},
+                {'name': 'empty'},
+            ]
+        }
+        _cb_config = {'root': 'https://test.com/',
+                      'references': {'refs': ['upstream', 'empty']}}
+
+        result = to_lobster(_cb_config, _cb_item)
+        self.assertEqual([tag.key() for tag in result.unresolved_references],
+                         ['req 2', 'req 3'])
+
+    def test_ensure_array_of_strings(self):
+        self.assertEqual(ensure_array_of_strings(['a', 'b']), ['a', 'b'])
+        self.assertEqual(ensure_array_of_strings([]), [])
+        self.assertEqual(ensure_array_of_strings('a'), ['a'])
+        self.assertEqual(ensure_array_of_strings(['a', 1]), ["['a', 1]"])
+
 
 if __name__ == '__main__':
     unittest.main()